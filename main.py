@@ -1,11 +1,12 @@
 import re
 import streamlit as st
-import tempfile
 import asyncio
 import json
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from services.drive import list_files, download_file
-from model_IV.scene_summarizer import story_breaking_agent
+from services.drive import list_files, download_file_cached
+from model_IV.scene_summarizer import story_breaking_agent, parse_fdx_to_canonical
 from model_IV.scene_writer_agent import (
     phase3_scene_construction,
     phase4_dialogue_pass,
@@ -25,38 +26,111 @@ st.set_page_config(layout="wide")
 st.title("Screenplay Pipeline")
 
 
+# =============================
+# Cached Drive / Parse Helpers
+# =============================
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_list_files(folder_id):
+    return list_files(folder_id)
+
+
+@st.cache_data(show_spinner=False)
+def cached_parse_fdx(fdx_path):
+    return parse_fdx_to_canonical(fdx_path)
+
+
+@st.cache_data(show_spinner=False)
+def cached_notes_text(file_id, modified_time):
+    # Keyed by Drive revision: the .docx is only parsed when it changes
+    doc = Document(download_file_cached(file_id, modified_time))
+    return "\n".join([p.text for p in doc.paragraphs])
+
+
+# =============================
+# Parallel Fetch Helper
+# =============================
+def fetch_parallel(calls):
+    # Drive calls are blocking I/O; threads mix cleanly with Streamlit's sync script
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        return list(ex.map(lambda c: c(), calls))
+
+
 # =============================
 # Load Drive Files
 # =============================
-screenplays = list_files(SCREENPLAYS_FOLDER_ID)
-notes_files = list_files(NOTES_FOLDER_ID)
+screenplays, notes_files = fetch_parallel([
+    lambda: cached_list_files(SCREENPLAYS_FOLDER_ID),
+    lambda: cached_list_files(NOTES_FOLDER_ID),
+])
 
 
 # =============================
 # Select Screenplay
 # =============================
+screenplays_by_name = {f["name"]: f for f in screenplays}
 screenplay_name = st.selectbox(
     "Select screenplay",
-    [f["name"] for f in screenplays]
+    list(screenplays_by_name)
 )
-screenplay_file = next(f for f in screenplays if f["name"] == screenplay_name)
+screenplay_file = screenplays_by_name[screenplay_name]
 
 
 # =============================
 # Select Notes
 # =============================
+notes_by_name = {f["name"]: f for f in notes_files}
 notes_name = st.selectbox(
     "Select notes (optional)",
-    ["None"] + [f["name"] for f in notes_files]
+    ["None"] + list(notes_by_name)
 )
 
 notes_text = ""
 if notes_name != "None":
-    notes_file = next(f for f in notes_files if f["name"] == notes_name)
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp_docx:
-        tmp_docx.write(download_file(notes_file["id"]))
-        doc = Document(tmp_docx.name)
-    notes_text = "\n".join([p.text for p in doc.paragraphs])
+    notes_file = notes_by_name[notes_name]
+    notes_text = cached_notes_text(notes_file["id"], notes_file.get("modifiedTime"))
+
+
+# =============================
+# Session Event Loop
+# =============================
+class SessionLoop:
+    # Owns one session's event loop and closes it once Streamlit drops the
+    # session state, so abandoned sessions don't pin loops (and their fds).
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        weakref.finalize(self, self.loop.close)
+
+
+def get_session_loop():
+    # Reused across clicks; the script thread changes per rerun, so the
+    # loop lives in the session rather than in a module global.
+    session_loop = st.session_state.get("session_loop")
+    if session_loop is None or session_loop.loop.is_closed():
+        session_loop = SessionLoop()
+        st.session_state["session_loop"] = session_loop
+    return session_loop
+
+
+def run_in_session_loop(coro):
+    # Holding session_loop keeps the loop open for the whole run
+    session_loop = get_session_loop()
+    loop = session_loop.loop
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        # A Streamlit rerun/stop raises out of run_until_complete with
+        # gather children still pending; cancel them so they don't resume
+        # (and write to stale placeholders) on the next click.
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True)
+            )
+        # Leave the session state as the loop's only owner
+        asyncio.set_event_loop(None)
 
 
 # =============================
@@ -167,9 +241,10 @@ def remove_duplicate_headings(parts: list) -> str:
 # =============================
 if st.button("Rewrite Screenplay"):
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".fdx") as tmp_fdx:
-        tmp_fdx.write(download_file(screenplay_file["id"]))
-        fdx_path = tmp_fdx.name
+    fdx_path = str(download_file_cached(
+        screenplay_file["id"], screenplay_file.get("modifiedTime")
+    ))
+    canonical = cached_parse_fdx(fdx_path)
 
     progress_text = st.empty()
     progress_bar = st.progress(0)
@@ -187,7 +262,8 @@ if st.button("Rewrite Screenplay"):
             phase12_data = await retry_async(
                 story_breaking_agent,
                 fdx_path,
-                notes=notes_text
+                notes=notes_text,
+                canonical=canonical,
             )
 
             story_dna = phase12_data["story_dna"]
@@ -286,12 +362,7 @@ if st.button("Rewrite Screenplay"):
 
             return phase12_data, final_script
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            phase12_data, final_script = loop.run_until_complete(run_pipeline())
-        finally:
-            loop.close()
+        phase12_data, final_script = run_in_session_loop(run_pipeline())
 
         st.session_state["phase12"] = phase12_data
         st.session_state["final_script"] = final_script
@@ -1,42 +1,19 @@
 import asyncio
 import json
 from typing import Dict, List
-from pathlib import Path
-import os
-import xml.etree.ElementTree as ET
 from collections import defaultdict
 
-from google import genai
 from google.genai import types
 
+from services._screenplay_core import assign_acts, parse_fdx_to_canonical
+from services.gemini import client, json_loads
+
 
 # =========================================================
 # GEMINI SETUP
 # =========================================================
 
-def get_gemini_api_key() -> str:
-    try:
-        import streamlit as st
-        if "GEMINI_API_KEY" in st.secrets:
-            return st.secrets["GEMINI_API_KEY"]
-    except Exception:
-        pass
-
-    from dotenv import load_dotenv
-    root_dir = Path(__file__).resolve().parents[1]
-    env_path = root_dir / ".env"
-    if env_path.exists():
-        load_dotenv(env_path)
-
-    key = os.getenv("GEMINI_API_KEY")
-    if not key:
-        raise RuntimeError("❌ GEMINI_API_KEY not found.")
-    return key
-
-
-API_KEY = get_gemini_api_key()
 MODEL_NAME = "gemini-2.5-flash"
-client = genai.Client(api_key=API_KEY)
 
 # Global concurrency limiter (shared across agents)
 SEMAPHORE = asyncio.Semaphore(5)
@@ -59,82 +36,13 @@ async def gemini_json_call(system_prompt: str, user_prompt: str, temperature: fl
                 ),
             )
 
-            return json.loads(response.text)
+            return json_loads(response.text)
 
         except Exception as e:
             print("Gemini JSON error:", e)
             return {}
 
 
-# =========================================================
-# FDX PARSER
-# =========================================================
-
-def parse_fdx_to_canonical(fdx_path: str) -> dict:
-    tree = ET.parse(fdx_path)
-    root = tree.getroot()
-
-    screenplay = {"scenes": []}
-    current_scene = None
-    scene_counter = 1
-    heading_count = defaultdict(int)
-
-    for para in root.iter("Paragraph"):
-        p_type = para.attrib.get("Type", "").strip()
-        text_node = para.find("Text")
-        text = (text_node.text or "").strip() if text_node is not None else ""
-
-        if not text:
-            continue
-
-        if p_type == "Scene Heading":
-            heading_norm = text.upper()
-            heading_count[heading_norm] += 1
-
-            scene_id = f"S{scene_counter:03}_{heading_count[heading_norm]}"
-            scene_counter += 1
-
-            if current_scene:
-                screenplay["scenes"].append(current_scene)
-
-            current_scene = {
-                "scene_id": scene_id,
-                "heading": text,
-                "elements": [],
-                "full_text": text,
-            }
-
-        else:
-            if current_scene:
-                current_scene["elements"].append(
-                    {"type": p_type, "text": text}
-                )
-                current_scene["full_text"] += "\n" + text
-
-    if current_scene:
-        screenplay["scenes"].append(current_scene)
-
-    return screenplay
-
-
-# =========================================================
-# ACT ASSIGNMENT (Simple 3-Act Split)
-# =========================================================
-
-def assign_acts(screenplay: dict):
-    total = len(screenplay["scenes"])
-
-    for i, scene in enumerate(screenplay["scenes"]):
-        ratio = i / max(total, 1)
-
-        if ratio < 0.25:
-            scene["act"] = "Act I"
-        elif ratio < 0.75:
-            scene["act"] = "Act II"
-        else:
-            scene["act"] = "Act III"
-
-
 # =========================================================
 # SCENE SUMMARY
 # =========================================================
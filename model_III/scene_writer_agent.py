@@ -2,6 +2,7 @@ import asyncio
 import json
 import re
 from google.genai import types
+from services.gemini import json_loads
 from model_III.scene_summarizer import client, MODEL_NAME, get_semaphore
 
 
@@ -18,12 +19,12 @@ def repair_common_json_issues(text: str) -> str:
 
 def safe_json_parse(text: str) -> dict:
     try:
-        return json.loads(text)
+        return json_loads(text)
     except json.JSONDecodeError:
         match = re.search(r"\{.*\}", text, re.DOTALL)
         if match:
             try:
-                return json.loads(match.group(0))
+                return json_loads(match.group(0))
             except Exception:
                 pass
     return {}
@@ -1,21 +1,29 @@
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload
 from google_auth_httplib2 import AuthorizedHttp
+from functools import lru_cache
 from io import BytesIO
+from pathlib import Path
 import httplib2
 import os
+import tempfile
 
 # -----------------------------
 # CONFIG
 # -----------------------------
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 SERVICE_ACCOUNT_FILE = "google_drive.json"
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CACHE_DIR = Path(os.getenv("DRIVE_CACHE_DIR", ".drive_cache"))
 
 
 # -----------------------------
 # CREATE DRIVE CLIENT
 # -----------------------------
+# Built once per process: the discovery build + credential parse is the
+# slowest part of every Drive call, and Streamlit reruns the script often.
+@lru_cache(maxsize=1)
 def get_drive_client():
     creds = None
 
@@ -42,6 +50,12 @@ def get_drive_client():
             scopes=SCOPES
         )
 
+    def build_request(http, *args, **kwargs):
+        # httplib2 is not thread-safe: give every request its own transport
+        # so the shared client can be used from worker threads.
+        new_http = AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+        return HttpRequest(new_http, *args, **kwargs)
+
     http = httplib2.Http(timeout=60)
     authed_http = AuthorizedHttp(creds, http=http)
 
@@ -49,6 +63,7 @@ def get_drive_client():
         "drive",
         "v3",
         http=authed_http,
+        requestBuilder=build_request,
         cache_discovery=False
     )
 
@@ -56,19 +71,37 @@ def get_drive_client():
 # -----------------------------
 # LIST FILES
 # -----------------------------
-def list_files(folder_id, mime_contains=None):
+def _quote(value: str) -> str:
+    # Drive query string literals escape backslashes and single quotes
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def list_files(folder_id, mime_contains=None, name=None):
     drive = get_drive_client()
 
     q = f"'{folder_id}' in parents and trashed = false"
     if mime_contains:
         q += f" and mimeType contains '{mime_contains}'"
+    if name:
+        q += f" and name = '{_quote(name)}'"
+
+    files = []
+    page_token = None
+
+    while True:
+        res = drive.files().list(
+            q=q,
+            pageSize=1000,
+            pageToken=page_token,
+            fields="nextPageToken, files(id, name, modifiedTime, md5Checksum)"
+        ).execute()
 
-    res = drive.files().list(
-        q=q,
-        fields="files(id, name)"
-    ).execute()
+        files.extend(res.get("files", []))
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            break
 
-    return res.get("files", [])
+    return files
 
 
 # -----------------------------
@@ -79,11 +112,49 @@ def download_file(file_id: str) -> bytes:
 
     request = drive.files().get_media(fileId=file_id)
     fh = BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
+    downloader = MediaIoBaseDownload(fh, request, chunksize=DOWNLOAD_CHUNK_SIZE)
 
     done = False
     while not done:
         _, done = downloader.next_chunk()
 
-    fh.seek(0)
-    return fh.read()
+    return fh.getvalue()
+
+
+# -----------------------------
+# DOWNLOAD FILE (DISK CACHED)
+# -----------------------------
+def download_file_cached(file_id: str, modified_time: str | None = None) -> Path:
+    """
+    Returns a local path holding the file's bytes, downloading only when
+    Drive reports a modifiedTime we have not stored yet. Pass the
+    `modifiedTime` from list_files to skip the metadata lookup.
+    """
+    if modified_time is None:
+        drive = get_drive_client()
+        meta = drive.files().get(fileId=file_id, fields="modifiedTime").execute()
+        modified_time = meta["modifiedTime"]
+
+    version = modified_time.replace(":", "").replace(".", "")
+    path = CACHE_DIR / f"{file_id}_{version}"
+
+    if path.exists():
+        return path
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temp name first so concurrent sessions never read a partial file
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, delete=False) as tmp:
+        try:
+            tmp.write(download_file(file_id))
+        except BaseException:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+    os.replace(tmp.name, path)
+
+    for stale in CACHE_DIR.glob(f"{file_id}_*"):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+
+    return path
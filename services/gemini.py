@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from google import genai
+
+# orjson is optional; its JSONDecodeError subclasses json.JSONDecodeError,
+# so callers catch the same exception either way.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+# ---------------------------------
+# LOAD API KEY
+# ---------------------------------
+@lru_cache(maxsize=1)
+def get_gemini_api_key() -> str:
+    try:
+        import streamlit as st
+        if "GEMINI_API_KEY" in st.secrets:
+            return st.secrets["GEMINI_API_KEY"]
+    except Exception:
+        pass
+
+    try:
+        from dotenv import load_dotenv
+
+        root_dir = Path(__file__).resolve().parents[1]
+        env_path = root_dir / ".env"
+
+        if env_path.exists():
+            load_dotenv(env_path)
+
+        key = os.getenv("GEMINI_API_KEY")
+        if key:
+            return key
+    except Exception:
+        pass
+
+    raise RuntimeError(
+        "❌ GEMINI_API_KEY not found.\n"
+        "Set it in Streamlit secrets or in a .env file."
+    )
+
+
+# ---------------------------------
+# SHARED CLIENT
+# ---------------------------------
+# Built once per process and shared by every service and model pipeline.
+MODEL_NAME = "gemini-2.5-pro"
+client = genai.Client(api_key=get_gemini_api_key())
+
+
+# ---------------------------------
+# CONCURRENCY CAP
+# ---------------------------------
+# Lazy per-loop so the Streamlit-owned loop gets its own semaphore;
+# keeps bursts of parallel scene rewrites under the Gemini QPM quota.
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+
+
+def get_semaphore(limit: int = MAX_CONCURRENCY) -> asyncio.Semaphore:
+    # Stored on the running loop, so it is only ever awaited on that loop
+    # and is freed with it; one semaphore per (loop, limit).
+    loop = asyncio.get_running_loop()
+    semaphores = getattr(loop, "_gemini_semaphores", None)
+    if semaphores is None:
+        semaphores = loop._gemini_semaphores = {}
+
+    semaphore = semaphores.get(limit)
+    if semaphore is None:
+        semaphore = semaphores[limit] = asyncio.Semaphore(limit)
+    return semaphore
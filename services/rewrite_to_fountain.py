@@ -1,159 +1,68 @@
 import asyncio
 import json
-import xml.etree.ElementTree as ET
-from copy import deepcopy
-from typing import Optional, List, Dict
-from pathlib import Path
-import os
+import random
+import re
+from typing import AsyncIterator, Optional, List, Dict
 
-from google import genai
-from google.genai import types
+import httpx
+from google.genai import errors, types
 
-
-# =========================================================
-# LOAD GEMINI API KEY
-# =========================================================
-def get_gemini_api_key() -> str:
-    try:
-        import streamlit as st
-        if "GEMINI_API_KEY" in st.secrets:
-            return st.secrets["GEMINI_API_KEY"]
-    except Exception:
-        pass
-
-    try:
-        from dotenv import load_dotenv
-        root_dir = Path(__file__).resolve().parents[1]
-        env_path = root_dir / ".env"
-        if env_path.exists():
-            load_dotenv(env_path)
-
-        key = os.getenv("GEMINI_API_KEY")
-        if key:
-            return key
-    except Exception:
-        pass
-
-    raise RuntimeError("❌ GEMINI_API_KEY not found.")
-
-
-API_KEY = get_gemini_api_key()
-MODEL_NAME = "gemini-2.5-pro"
-client = genai.Client(api_key=API_KEY)
+from services._screenplay_core import (
+    assign_acts,
+    parse_fdx_to_canonical,
+    screenplay_to_fountain,
+)
+from services.gemini import client, MODEL_NAME, get_semaphore
+from services.notes_to_json import notes_docx_to_change_plan
 
 
 # =========================================================
-# FDX → CANONICAL JSON
+# FILTER CHANGES PER SCENE
 # =========================================================
-def parse_fdx_to_canonical(fdx_path: str) -> dict:
-    tree = ET.parse(fdx_path)
-    root = tree.getroot()
-
-    screenplay = {"scenes": []}
-    current_scene = None
-    scene_counter = 1
+ACTS = ("Act I", "Act II", "Act III")
+_ACT_RE = re.compile(r"\bACT (III|II|I)\b")
 
-    for para in root.iter("Paragraph"):
-        p_type = para.attrib.get("Type", "").strip()
-        text_node = para.find("Text")
-        text = (text_node.text or "").strip() if text_node is not None else ""
 
-        if not text:
-            continue
+def index_changes_by_act(change_plan: dict) -> List[tuple]:
+    """
+    Resolves each change's placement to the set of acts it targets, once
+    per plan. Whole-word match, so "Act I" no longer matches "Act II".
+    """
+    change_acts = []
 
-        if p_type == "Scene Heading":
-            if current_scene:
-                screenplay["scenes"].append(current_scene)
+    for change in change_plan.get("scene_level_changes", []):
+        placement = change.get("placement", "").upper()
 
-            current_scene = {
-                "scene_id": f"S{scene_counter:03}",
-                "heading": text,
-                "elements": []
-            }
-            scene_counter += 1
+        if "ENTIRE SCREENPLAY" in placement:
+            acts = set(ACTS)
         else:
-            if current_scene:
-                current_scene["elements"].append({
-                    "type": p_type,
-                    "text": text
-                })
-
-    if current_scene:
-        screenplay["scenes"].append(current_scene)
-
-    return screenplay
-
-
-# =========================================================
-# CONVERT CANONICAL → FOUNTAIN
-# =========================================================
-def screenplay_to_fountain(screenplay: dict) -> str:
-    lines = []
-
-    for scene in screenplay["scenes"]:
-        lines.append(scene["heading"].upper())
-        lines.append("")
+            acts = {f"Act {m}" for m in _ACT_RE.findall(placement)}
 
-        for el in scene["elements"]:
-            t = el.get("type", "Action")
-            text = el["text"].strip()
+        change_acts.append((change, acts))
 
-            if t == "Character":
-                lines.append(text.upper())
-            elif t == "Parenthetical":
-                lines.append(f"({text})")
-            else:
-                lines.append(text)
+    return change_acts
 
-            lines.append("")
 
-        lines.append("")
+def get_relevant_changes_for_scene(scene: dict, change_acts: List[tuple]) -> List[Dict]:
+    act = scene.get("act", "")
+    return [change for change, acts in change_acts if act in acts]
 
-    return "\n".join(lines).strip()
 
-
-# =========================================================
-# ACT ASSIGNMENT
 # =========================================================
-def assign_acts(screenplay: dict):
-    total = len(screenplay["scenes"])
-    for i, scene in enumerate(screenplay["scenes"]):
-        ratio = i / max(total, 1)
-        if ratio < 0.25:
-            scene["act"] = "Act I"
-        elif ratio < 0.75:
-            scene["act"] = "Act II"
-        else:
-            scene["act"] = "Act III"
-
-
-# =========================================================
-# FILTER CHANGES PER SCENE
+# FOUNTAIN PARSER
 # =========================================================
-def get_relevant_changes_for_scene(scene: dict, change_plan: dict) -> List[Dict]:
-    relevant = []
-
-    for change in change_plan.get("scene_level_changes", []):
-        placement = change.get("placement", "").upper()
+_PAREN_RE = re.compile(r"^\((.*)\)$")
 
-        if placement == "ENTIRE SCREENPLAY":
-            relevant.append(change)
-        elif scene.get("act", "").upper() in placement:
-            relevant.append(change)
 
-    return relevant
-
-
-# =========================================================
-# FOUNTAIN PARSER
-# =========================================================
 def parse_fountain_scene(fountain_text: str, original_scene_id: str) -> dict:
-    lines = fountain_text.split("\n")
+    # splitlines() also copes with \r\n from the model
+    lines = fountain_text.splitlines() or [""]
 
+    elements = []
     scene = {
         "scene_id": original_scene_id,
         "heading": lines[0].strip(),
-        "elements": []
+        "elements": elements
     }
 
     current_type = "Action"
@@ -163,25 +72,18 @@ def parse_fountain_scene(fountain_text: str, original_scene_id: str) -> dict:
         if not line:
             continue
 
-        if line.isupper() and not line.startswith("("):
+        m = _PAREN_RE.match(line)
+        if m:
+            elements.append({"type": "Parenthetical", "text": m.group(1)})
+        # isupper() keeps extensions like "JOHN (V.O.)" as Character
+        elif line.isupper() and line[0] != "(":
             current_type = "Character"
-            scene["elements"].append({"type": "Character", "text": line})
-        elif line.startswith("(") and line.endswith(")"):
-            scene["elements"].append({
-                "type": "Parenthetical",
-                "text": line[1:-1]
-            })
+            elements.append({"type": "Character", "text": line})
         else:
-            if current_type == "Character":
-                scene["elements"].append({
-                    "type": "Dialogue",
-                    "text": line
-                })
-            else:
-                scene["elements"].append({
-                    "type": "Action",
-                    "text": line
-                })
+            elements.append({
+                "type": "Dialogue" if current_type == "Character" else "Action",
+                "text": line
+            })
 
     return scene
 
@@ -189,14 +91,7 @@ def parse_fountain_scene(fountain_text: str, original_scene_id: str) -> dict:
 # =========================================================
 # GEMINI REWRITE WITH SCENE-LEVEL SUMMARY
 # =========================================================
-async def rewrite_scene_with_gemini(scene: dict, relevant_changes: List[Dict]):
-
-    if not relevant_changes:
-        return scene, None
-
-    scene_fountain = screenplay_to_fountain({"scenes": [scene]})
-
-    system_prompt = """
+SYSTEM_PROMPT = """
 You are a professional screenplay rewrite engine.
 
 Rules:
@@ -210,10 +105,19 @@ Rules:
 - Do NOT explain line-by-line.
 """
 
-    user_prompt = f"""
+
+async def rewrite_scene_with_gemini(scene: dict, changes_json: str):
+
+    scene_fountain = screenplay_to_fountain({"scenes": [scene]})
+
+    # The change list is identical for every scene in an act, so it rides in
+    # the system instruction: a shared prefix Gemini can cache across calls
+    system_instruction = f"""{SYSTEM_PROMPT}
 CHANGE INSTRUCTIONS:
-{json.dumps(relevant_changes, indent=2)}
+{changes_json}
+"""
 
+    user_prompt = f"""
 SCENE:
 {scene_fountain}
 """
@@ -221,8 +125,16 @@ SCENE:
     response = await asyncio.to_thread(
         client.models.generate_content,
         model=MODEL_NAME,
-        contents=[system_prompt, user_prompt],
-        config=types.GenerateContentConfig(temperature=0.6),
+        contents=[
+            types.Content(
+                role="user",
+                parts=[types.Part(text=user_prompt)]
+            )
+        ],
+        config=types.GenerateContentConfig(
+            system_instruction=system_instruction,
+            temperature=0.6,
+        ),
     )
 
     rewritten_text = response.text.strip()
@@ -243,28 +155,80 @@ SCENE:
 
 
 # =========================================================
-# MAIN ENTRY
+# RETRY + CONCURRENCY GUARD
 # =========================================================
-async def rewrite_fdx_with_plan(
-    fdx_path: str,
+MAX_ATTEMPTS = 4
+RETRYABLE_CODES = {429, 500, 503, 504}
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, errors.APIError):
+        return e.code in RETRYABLE_CODES
+    # google-genai goes through httpx: timeouts and dropped connections
+    # surface as httpx.TransportError, not the builtin TimeoutError
+    return isinstance(e, (TimeoutError, httpx.TransportError))
+
+
+async def _rewrite_scene_guarded(scene: dict, changes_json: str):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            # Each attempt takes a slot; the backoff sleep below does not
+            async with get_semaphore():
+                rewritten, summary = await rewrite_scene_with_gemini(scene, changes_json)
+
+            if rewritten["elements"] or not scene["elements"]:
+                return rewritten, summary
+            error = ValueError("Gemini returned an empty scene.")
+
+        except Exception as e:
+            if not _is_retryable(e):
+                raise
+            error = e
+
+        if attempt < MAX_ATTEMPTS - 1:
+            await asyncio.sleep(min(2 ** attempt + random.random(), 20))
+
+    raise error
+
+
+# =========================================================
+# STREAMING ENTRY
+# =========================================================
+# Scenes below these are not worth a Gemini call (headings, bare transitions)
+MIN_REWRITE_ELEMENTS = 1
+MIN_REWRITE_CHARS = 40
+
+
+async def _rewrite_scene_indexed(idx: int, scene: dict, changes_json: str):
+    try:
+        return idx, await _rewrite_scene_guarded(scene, changes_json), None
+    except Exception as e:
+        return idx, None, e
+
+
+async def rewrite_fdx_with_plan_stream(
+    canonical: dict,
     change_plan: dict,
     start_scene: Optional[int] = None,
     end_scene: Optional[int] = None
-):
-
-    canonical = parse_fdx_to_canonical(fdx_path)
+) -> AsyncIterator[dict]:
+    """
+    Yields one event per rewritten scene as soon as its Gemini call
+    finishes, so a UI can render results before the slowest scene is back.
+    Failed scenes yield an event with an "error" key instead, and scenes
+    with too little text to rewrite yield one with a "skipped" key.
+    """
     assign_acts(canonical)
+    change_acts = index_changes_by_act(change_plan)
 
-    updated = deepcopy(canonical)
-
-    diff_report = {
-        "fdx_file": fdx_path,
-        "scenes_changed": []
-    }
-
+    relevant_by_idx = {}
+    # Scenes in the same act share a change list; serialize each list once,
+    # compact: indentation is only extra prompt tokens
+    changes_json_by_ids = {}
     tasks = []
+    skipped = []
 
-    for i, scene in enumerate(updated["scenes"]):
+    for i, scene in enumerate(canonical["scenes"]):
         scene_number = i + 1
 
         if start_scene is not None and scene_number < start_scene:
@@ -272,36 +236,134 @@ async def rewrite_fdx_with_plan(
         if end_scene is not None and scene_number > end_scene:
             continue
 
-        relevant_changes = get_relevant_changes_for_scene(scene, change_plan)
+        relevant_changes = get_relevant_changes_for_scene(scene, change_acts)
 
         if relevant_changes:
-            tasks.append((i, relevant_changes))
-
-    if tasks:
-        results = await asyncio.gather(
-            *[
-                rewrite_scene_with_gemini(updated["scenes"][i], changes)
-                for i, changes in tasks
+            rewritable = [
+                el["text"] for el in scene["elements"]
+                if el.get("type") != "Transition" and el.get("text", "").strip()
             ]
-        )
+            if (len(rewritable) < MIN_REWRITE_ELEMENTS
+                    or sum(map(len, rewritable)) < MIN_REWRITE_CHARS):
+                skipped.append({
+                    "scene_index": scene_number,
+                    "scene_id": scene["scene_id"],
+                    "skipped": "unchanged -- too little text to rewrite"
+                })
+                continue
 
-        for (idx, relevant_changes), (rewritten, summary) in zip(tasks, results):
+            key = tuple(c["change_id"] for c in relevant_changes)
+            if key not in changes_json_by_ids:
+                changes_json_by_ids[key] = json.dumps(relevant_changes, ensure_ascii=False)
 
+            relevant_by_idx[i] = relevant_changes
+            tasks.append(asyncio.ensure_future(
+                _rewrite_scene_indexed(i, scene, changes_json_by_ids[key])
+            ))
+
+    try:
+        for event in skipped:
+            yield event
+
+        for next_done in asyncio.as_completed(tasks):
+            idx, result, error = await next_done
             original = canonical["scenes"][idx]
 
-            diff_report["scenes_changed"].append({
+            if error is not None:
+                yield {
+                    "scene_index": idx + 1,
+                    "scene_id": original["scene_id"],
+                    "error": str(error)
+                }
+                continue
+
+            rewritten, summary = result
+            yield {
                 "scene_index": idx + 1,
                 "scene_id": original["scene_id"],
                 "heading": original["heading"],
                 "applied_change_ids": [
-                    c["change_id"] for c in relevant_changes
+                    c["change_id"] for c in relevant_by_idx[idx]
                 ],
-                "change_summary": summary
-            })
+                "change_summary": summary,
+                "rewritten": rewritten
+            }
+    finally:
+        # Consumer stopped early: don't leave Gemini calls running
+        for task in tasks:
+            task.cancel()
+
 
-            updated["scenes"][idx] = rewritten
+# =========================================================
+# MAIN ENTRY
+# =========================================================
+async def rewrite_fdx_with_plan(
+    fdx_path: str,
+    change_plan: dict,
+    start_scene: Optional[int] = None,
+    end_scene: Optional[int] = None,
+    canonical: Optional[dict] = None
+):
+
+    if canonical is None:
+        canonical = parse_fdx_to_canonical(fdx_path)
+
+    # Rewrites replace whole scene dicts and never mutate originals,
+    # so copying the scene list is enough
+    updated = {**canonical, "scenes": list(canonical["scenes"])}
+
+    diff_report = {
+        "fdx_file": fdx_path,
+        "scenes_changed": [],
+        "scenes_failed": [],
+        "scenes_skipped": []
+    }
+
+    async for event in rewrite_fdx_with_plan_stream(
+        canonical, change_plan, start_scene, end_scene
+    ):
+        # One failed scene keeps its original text instead of sinking the run
+        if "error" in event:
+            diff_report["scenes_failed"].append(event)
+            continue
+        if "skipped" in event:
+            diff_report["scenes_skipped"].append(event)
+            continue
+
+        updated["scenes"][event["scene_index"] - 1] = event.pop("rewritten")
+        diff_report["scenes_changed"].append(event)
+
+    # Events arrive in completion order; report in screenplay order
+    diff_report["scenes_changed"].sort(key=lambda e: e["scene_index"])
+    diff_report["scenes_failed"].sort(key=lambda e: e["scene_index"])
 
     return {
         "fountain_text": screenplay_to_fountain(updated),
         "diff_report": diff_report
     }
+
+
+# =========================================================
+# NOTES + FDX ENTRY (OVERLAPPED)
+# =========================================================
+async def rewrite_fdx_with_notes(
+    fdx_path: str,
+    notes_path: str,
+    start_scene: Optional[int] = None,
+    end_scene: Optional[int] = None
+):
+    # The notes -> plan Gemini call and the FDX parse are independent
+    change_plan, canonical = await asyncio.gather(
+        asyncio.to_thread(notes_docx_to_change_plan, notes_path),
+        asyncio.to_thread(parse_fdx_to_canonical, fdx_path),
+    )
+
+    result = await rewrite_fdx_with_plan(
+        fdx_path,
+        change_plan,
+        start_scene=start_scene,
+        end_scene=end_scene,
+        canonical=canonical
+    )
+    result["change_plan"] = change_plan
+    return result
@@ -1,78 +1,30 @@
-import os
-import xml.etree.ElementTree as ET
-from pathlib import Path
-from docx import Document
-from google import genai
+import asyncio
+
 from google.genai import types
 
+from services._screenplay_core import iter_fdx_paragraphs
+from services.gemini import client, MODEL_NAME, get_semaphore
+from services.notes_to_json import read_docx
+
 # ==========================
 # CONFIG
 # ==========================
 
-MODEL_NAME = "gemini-2.5-pro"
 MIN_LENGTH_RATIO = 0.85
 MAX_OUTPUT_TOKENS_PER_SCENE = 8000
 MIN_SCENE_WORDS = 20
 
 
-# ==========================
-# GEMINI CLIENT
-# ==========================
-
-def get_gemini_api_key() -> str:
-    try:
-        import streamlit as st
-        if "GEMINI_API_KEY" in st.secrets:
-            return st.secrets["GEMINI_API_KEY"]
-    except Exception:
-        pass
-
-    from dotenv import load_dotenv
-    load_dotenv()
-    key = os.getenv("GEMINI_API_KEY")
-
-    if not key:
-        raise RuntimeError("❌ GEMINI_API_KEY not found.")
-
-    return key
-
-
-client = genai.Client(api_key=get_gemini_api_key())
-
-
-# ==========================
-# READ DOCX
-# ==========================
-
-def read_docx(file_path: str) -> str:
-    doc = Document(file_path)
-    return "\n".join(
-        p.text.strip()
-        for p in doc.paragraphs
-        if p.text.strip()
-    )
-
-
 # ==========================
 # FDX → SCENES (FOUNTAIN)
 # ==========================
 
 def fdx_to_fountain_scenes(fdx_path: str):
-    tree = ET.parse(fdx_path)
-    root = tree.getroot()
-
     scenes = []
     current_scene = []
     first_heading_skipped = False
 
-    for para in root.iter("Paragraph"):
-        p_type = para.attrib.get("Type", "").strip()
-        text_node = para.find("Text")
-
-        if text_node is None:
-            continue
-
-        text = (text_node.text or "").strip()
+    for p_type, text in iter_fdx_paragraphs(fdx_path):
         if not text:
             continue
 
@@ -119,9 +71,7 @@ def fdx_to_fountain_scenes(fdx_path: str):
 # SCENE REWRITE
 # ==========================
 
-def rewrite_scene(scene_text: str, notes_text: str, retry=1):
-
-    system_prompt = """
+SYSTEM_PROMPT = """
 You are a professional screenplay rewrite engine.
 
 Rewrite the provided scene based on the development notes.
@@ -136,6 +86,9 @@ STRICT RULES:
 - Output ONLY the rewritten scene.
 """
 
+
+async def rewrite_scene(scene_text: str, notes_text: str, retry=1):
+
     user_prompt = f"""
 DEVELOPMENT NOTES:
 {notes_text}
@@ -145,22 +98,25 @@ SCENE TO REWRITE (FOUNTAIN):
 {scene_text}
 """
 
-    response = client.models.generate_content(
-        model=MODEL_NAME,
-        contents=[system_prompt, user_prompt],
-        config=types.GenerateContentConfig(
-            temperature=0.6,
-            max_output_tokens=MAX_OUTPUT_TOKENS_PER_SCENE
-        )
+    contents = [SYSTEM_PROMPT, user_prompt]
+    config = types.GenerateContentConfig(
+        temperature=0.6,
+        max_output_tokens=MAX_OUTPUT_TOKENS_PER_SCENE
     )
+    min_wc = len(scene_text.split()) * MIN_LENGTH_RATIO
+
+    # Retry too-short rewrites in place; same prompt and config each time
+    for _ in range(max(retry, 0) + 1):
+        response = await asyncio.to_thread(
+            client.models.generate_content,
+            model=MODEL_NAME,
+            contents=contents,
+            config=config
+        )
 
-    rewritten = response.text.strip()
-
-    original_wc = len(scene_text.split())
-    rewritten_wc = len(rewritten.split())
-
-    if rewritten_wc < original_wc * MIN_LENGTH_RATIO and retry > 0:
-        return rewrite_scene(scene_text, notes_text, retry=retry - 1)
+        rewritten = response.text.strip()
+        if len(rewritten.split()) >= min_wc:
+            break
 
     return rewritten
 
@@ -169,7 +125,12 @@ SCENE TO REWRITE (FOUNTAIN):
 # MAIN REWRITE FUNCTION
 # ==========================
 
-def rewrite_fdx_scene_by_scene(
+async def _rewrite_scene_guarded(scene_text: str, notes_text: str) -> str:
+    async with get_semaphore():
+        return await rewrite_scene(scene_text, notes_text)
+
+
+async def rewrite_fdx_scene_by_scene(
     fdx_path: str,
     notes_path: str,
     start_scene: int | None = None,
@@ -179,20 +140,30 @@ def rewrite_fdx_scene_by_scene(
     scenes = fdx_to_fountain_scenes(fdx_path)
     notes_text = read_docx(notes_path)
 
-    rewritten_scenes = []
-
-    for i, scene in enumerate(scenes, start=1):
-
+    def in_range(i: int) -> bool:
         if start_scene and i < start_scene:
-            rewritten_scenes.append(scene)
-            continue
-
+            return False
         if end_scene and i > end_scene:
-            rewritten_scenes.append(scene)
-            continue
-
-        rewritten = rewrite_scene(scene, notes_text)
-        rewritten_scenes.append(rewritten)
+            return False
+        return True
+
+    # Scene rewrites are independent; run them concurrently under the cap
+    tasks = {
+        i: asyncio.ensure_future(_rewrite_scene_guarded(scene, notes_text))
+        for i, scene in enumerate(scenes, start=1)
+        if in_range(i)
+    }
+    try:
+        # A failed scene fails the run, as the sequential version did
+        results = await asyncio.gather(*tasks.values())
+    finally:
+        # Don't leave the other rewrites running after a failure
+        for task in tasks.values():
+            task.cancel()
+
+    rewritten_scenes = list(scenes)
+    for i, result in zip(tasks, results):
+        rewritten_scenes[i - 1] = result
 
     final_script = "\n\n".join(rewritten_scenes)
 